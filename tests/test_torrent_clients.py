@@ -0,0 +1,412 @@
+import importlib
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from xmlrpc.server import SimpleXMLRPCDispatcher, SimpleXMLRPCServer
+
+# CrossSeedAutoDL parses its arguments and opens its log file when it is imported
+TEMP_DIR = tempfile.TemporaryDirectory()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_argv, _cwd = sys.argv, os.getcwd()
+sys.argv = ['CrossSeedAutoDL.py', '-s', TEMP_DIR.name, '-j', 'http://127.0.0.1:9117', '-k', 'api_key']
+os.chdir(TEMP_DIR.name)
+try:
+    CrossSeedAutoDL = importlib.import_module('CrossSeedAutoDL')
+finally:
+    sys.argv = _argv
+    os.chdir(_cwd)
+
+
+def make_hash(n):
+    return f'{n:040x}'
+
+
+class FakeClientServer:
+    """
+    in-process fake of the qBittorrent WebUI API and the Transmission RPC endpoint, recording every request
+    """
+    def __init__(self):
+        self.requests = []
+        # qBittorrent: lowercase infohash -> name, the sync rid and the torrents reported in the last response
+        self.qb_torrents = {}
+        self.qb_rid = 0
+        self.qb_reported = set()
+        self.qb_sid = 'SID1'
+        # transmission: id -> lowercase infohash
+        self.tr_torrents = {}
+        self.tr_recently_active = set()
+        self.tr_removed = []
+        self.tr_session_id = 'SESSION1'
+        self.tr_seconds_active = 1000
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self, 'GET', b'')
+
+            def do_POST(self):
+                fake.handle(self, 'POST', self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def restart_qbittorrent(self):
+        # sessions and rids do not survive a restart
+        self.qb_sid = self.qb_sid + 'x'
+        self.qb_rid = 0
+
+    def restart_transmission(self):
+        self.tr_seconds_active = 5
+        self.tr_session_id = self.tr_session_id + 'x'
+        # ids are reassigned in a different order
+        self.tr_torrents = {torrent_id + 100: h for torrent_id, h in self.tr_torrents.items()}
+
+    def handle(self, handler, method, body):
+        url = urlsplit(handler.path)
+        if url.path.startswith('/api/v2/'):
+            status, text, headers = self.handle_qbittorrent(handler, method, url, body)
+        elif url.path == '/transmission/rpc':
+            status, text, headers = self.handle_transmission(handler, body)
+        else:
+            status, text, headers = 404, '', {}
+        data = text.encode('utf8')
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def handle_qbittorrent(self, handler, method, url, body):
+        if url.path == '/api/v2/auth/login':
+            self.requests.append(('login', parse_qs(body.decode('utf8'))))
+            if parse_qs(body.decode('utf8')) != {'username': ['admin'], 'password': ['secret']}:
+                return 200, 'Fails.', {}
+            return 200, 'Ok.', {'Set-Cookie': f'SID={self.qb_sid}; path=/'}
+
+        if f'SID={self.qb_sid}' not in (handler.headers.get('Cookie') or ''):
+            self.requests.append(('forbidden', url.path))
+            return 403, 'Forbidden', {}
+        if url.path == '/api/v2/app/webapiVersion':
+            return 200, '2.8.3', {}
+
+        rid = int(parse_qs(url.query)['rid'][0])
+        self.requests.append(('maindata', rid))
+        current = set(self.qb_torrents)
+        if rid == 0 or rid != self.qb_rid:
+            maindata = {'full_update': True, 'torrents': {h: {'name': self.qb_torrents[h]} for h in current}}
+        else:
+            maindata = {'torrents': {h: {'name': self.qb_torrents[h]} for h in current - self.qb_reported}}
+            if self.qb_reported - current:
+                maindata['torrents_removed'] = sorted(self.qb_reported - current)
+        self.qb_rid += 1
+        self.qb_reported = current
+        maindata['rid'] = self.qb_rid
+        return 200, json.dumps(maindata), {}
+
+    def handle_transmission(self, handler, body):
+        if handler.headers.get('X-Transmission-Session-Id') != self.tr_session_id:
+            self.requests.append(('409', None))
+            return 409, '', {'X-Transmission-Session-Id': self.tr_session_id}
+
+        request = json.loads(body)
+        arguments = request['arguments']
+        self.requests.append((request['method'], arguments.get('ids')))
+        if request['method'] == 'session-stats':
+            return 200, json.dumps({'result': 'success', 'arguments': {
+                'current-stats': {'secondsActive': self.tr_seconds_active}}}), {}
+        if request['method'] != 'torrent-get':
+            return 200, json.dumps({'result': 'success', 'arguments': {}}), {}
+
+        ids = arguments.get('ids')
+        if ids is None:
+            selected = self.tr_torrents
+        elif ids == 'recently-active':
+            selected = {i: h for i, h in self.tr_torrents.items() if i in self.tr_recently_active}
+        else:
+            selected = {i: h for i, h in self.tr_torrents.items() if i in ids}
+        torrents = [{k: v for k, v in {'id': i, 'hashString': h}.items() if k in arguments['fields']}
+                    for i, h in sorted(selected.items())]
+        result = {'torrents': torrents}
+        if ids == 'recently-active':
+            result['removed'] = self.tr_removed
+        return 200, json.dumps({'result': 'success', 'arguments': result}), {}
+
+    def pop_requests(self):
+        requests, self.requests = self.requests, []
+        return requests
+
+
+class FakeRtorrent:
+    """
+    in-process fake of rtorrent's XML-RPC API, served over HTTP like an XMLRPC proxy and over SCGI like rtorrent itself
+    """
+    def __init__(self):
+        # uppercase infohashes, as returned by rtorrent
+        self.torrents = []
+        self.calls = []
+
+        self.http_server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False)
+        self.scgi_dispatcher = SimpleXMLRPCDispatcher()
+        for dispatcher in (self.http_server, self.scgi_dispatcher):
+            dispatcher.register_introspection_functions()
+            dispatcher.register_function(self.download_list, 'download_list')
+        self.http_url = f'http://127.0.0.1:{self.http_server.server_address[1]}/RPC2'
+
+        fake = self
+
+        class SCGIHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                # netstring of NUL separated headers, followed by the request body
+                header_length = int(b''.join(iter(lambda: self.rfile.read(1), b':')))
+                header_items = self.rfile.read(header_length + 1)[:-1].split(b'\x00')
+                headers = dict(zip(header_items[::2], header_items[1::2]))
+                body = self.rfile.read(int(headers[b'CONTENT_LENGTH']))
+                response = fake.scgi_dispatcher._marshaled_dispatch(body)
+                self.wfile.write(b'Status: 200 OK\r\nContent-Type: text/xml\r\n\r\n' + response)
+
+        self.scgi_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SCGIHandler)
+        self.scgi_url = f'scgi://127.0.0.1:{self.scgi_server.server_address[1]}'
+
+        for server in (self.http_server, self.scgi_server):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def close(self):
+        for server in (self.http_server, self.scgi_server):
+            server.shutdown()
+            server.server_close()
+
+    def download_list(self):
+        self.calls.append('download_list')
+        return list(self.torrents)
+
+
+class ClientTestCase(unittest.TestCase):
+    client_class = None
+
+    def setUp(self):
+        self.fake = FakeClientServer()
+        self.addCleanup(self.fake.close)
+        self.snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.snapshot_dir.cleanup)
+        # snapshots are written next to the script, keep them out of the repository
+        patcher = mock.patch.object(CrossSeedAutoDL, '__file__', os.path.join(self.snapshot_dir.name, 'script.py'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class RtorrentClientTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeRtorrent()
+        self.addCleanup(self.fake.close)
+        self.fake.torrents = [make_hash(n).upper() for n in range(1, 4)]
+
+    def check_client(self, url):
+        client = CrossSeedAutoDL.RtorrentClient(url)
+        client.check_connection()
+        self.assertFalse(client.incremental)
+
+        infohashes = client.sync()
+        self.assertEqual(infohashes, {make_hash(n).upper() for n in range(1, 4)})
+
+        # the whole list is fetched again, and the set is updated in place
+        self.fake.torrents = [make_hash(n).upper() for n in range(2, 5)]
+        self.assertIs(client.sync(), infohashes)
+        self.assertEqual(infohashes, {make_hash(n).upper() for n in range(2, 5)})
+        self.assertEqual(self.fake.calls, ['download_list', 'download_list'])
+
+    def test_http(self):
+        self.check_client(self.fake.http_url)
+
+    def test_scgi(self):
+        self.check_client(self.fake.scgi_url)
+
+    def test_connection_error(self):
+        url = self.fake.http_url
+        self.fake.close()
+        with self.assertRaises(ConnectionError):
+            CrossSeedAutoDL.RtorrentClient(url).check_connection()
+
+
+class QBittorrentClientTest(ClientTestCase):
+    client_class = CrossSeedAutoDL.QBittorrentClient
+
+    def setUp(self):
+        super().setUp()
+        self.url = self.fake.url.replace('http://', 'http://admin:secret@')
+        self.fake.qb_torrents = {make_hash(n): f'torrent {n}' for n in range(1, 4)}
+
+    def test_first_sync_logs_in_and_lists_everything(self):
+        client = self.client_class(self.url)
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 4)})
+        self.assertEqual(self.fake.pop_requests(), [
+            ('forbidden', '/api/v2/sync/maindata'),
+            ('login', {'username': ['admin'], 'password': ['secret']}),
+            ('maindata', 0)
+        ])
+
+    def test_delta_sync(self):
+        client = self.client_class(self.url)
+        client.sync()
+        self.fake.pop_requests()
+
+        self.fake.qb_torrents[make_hash(4)] = 'torrent 4'
+        del self.fake.qb_torrents[make_hash(1)]
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(2, 5)})
+        self.assertEqual(self.fake.pop_requests(), [('maindata', 1)])
+
+        # nothing changed
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(2, 5)})
+        self.assertEqual(self.fake.pop_requests(), [('maindata', 2)])
+
+    def test_full_update_replaces_infohashes(self):
+        client = self.client_class(self.url)
+        client.sync()
+        # the server no longer knows the rid, eg. because it expired
+        self.fake.qb_rid = 100
+        self.fake.qb_torrents = {make_hash(7): 'torrent 7'}
+        self.assertEqual(client.sync(), {make_hash(7).upper()})
+
+    def test_later_run_resumes_from_snapshot(self):
+        self.client_class(self.url).sync()
+        self.fake.pop_requests()
+
+        self.fake.qb_torrents[make_hash(4)] = 'torrent 4'
+        client = self.client_class(self.url)
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 5)})
+        # the session cookie and rid were reused, so there was no login and no full update
+        self.assertEqual(self.fake.pop_requests(), [('maindata', 1)])
+
+    def test_relogin_after_session_expired(self):
+        self.client_class(self.url).sync()
+        self.fake.restart_qbittorrent()
+        del self.fake.qb_torrents[make_hash(3)]
+        self.fake.pop_requests()
+
+        client = self.client_class(self.url)
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 3)})
+        # the rid of the expired session is not sent again after logging in
+        self.assertEqual(self.fake.pop_requests(), [
+            ('forbidden', '/api/v2/sync/maindata'),
+            ('login', {'username': ['admin'], 'password': ['secret']}),
+            ('maindata', 0)
+        ])
+
+    def test_failed_login(self):
+        client = self.client_class(self.url.replace('secret', 'wrong'))
+        with self.assertRaises(CrossSeedAutoDL.TorrentClientError):
+            client.sync()
+
+
+class TransmissionClientTest(ClientTestCase):
+    client_class = CrossSeedAutoDL.TransmissionClient
+
+    def setUp(self):
+        super().setUp()
+        self.url = f'{self.fake.url}/transmission/rpc'
+        self.fake.tr_torrents = {n: make_hash(n) for n in range(1, 4)}
+
+    def test_first_sync_gets_session_id_and_lists_everything(self):
+        client = self.client_class(self.url)
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 4)})
+        self.assertEqual(self.fake.pop_requests(), [
+            ('409', None),
+            ('session-stats', None),
+            ('torrent-get', None),
+            ('torrent-get', [1, 2, 3])
+        ])
+
+    def test_recently_active_with_removed(self):
+        client = self.client_class(self.url)
+        client.sync()
+        self.fake.pop_requests()
+
+        self.fake.tr_torrents[4] = make_hash(4)
+        del self.fake.tr_torrents[1]
+        self.fake.tr_recently_active = {4}
+        self.fake.tr_removed = [1]
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(2, 5)})
+        self.assertEqual(self.fake.pop_requests(), [('session-stats', None), ('torrent-get', 'recently-active')])
+
+    def test_later_run_only_fetches_new_infohashes(self):
+        self.client_class(self.url).sync()
+        self.fake.pop_requests()
+
+        self.fake.tr_torrents[4] = make_hash(4)
+        del self.fake.tr_torrents[2]
+        client = self.client_class(self.url)
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in (1, 3, 4)})
+        self.assertEqual(self.fake.pop_requests(), [
+            ('409', None),
+            ('session-stats', None),
+            ('torrent-get', None),
+            ('torrent-get', [4])
+        ])
+
+    def test_rotated_session_id_keeps_torrent_ids(self):
+        client = self.client_class(self.url)
+        client.sync()
+        self.fake.pop_requests()
+
+        self.fake.tr_session_id = 'SESSION2'
+        client.last_sync = None
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 4)})
+        # the 409 handshake is repeated, but the infohashes of the known ids are not fetched again
+        self.assertEqual(self.fake.pop_requests(), [
+            ('409', None),
+            ('session-stats', None),
+            ('torrent-get', None)
+        ])
+
+    def test_restart_lists_everything_again(self):
+        self.client_class(self.url).sync()
+        self.fake.restart_transmission()
+        self.fake.tr_torrents[1] = make_hash(4)
+        self.fake.pop_requests()
+
+        # the id of a torrent from before the restart now belongs to another torrent
+        client = self.client_class(self.url)
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 5)})
+        self.assertEqual(self.fake.pop_requests(), [
+            ('409', None),
+            ('session-stats', None),
+            ('torrent-get', None),
+            ('torrent-get', [1, 101, 102, 103])
+        ])
+
+    def test_restart_between_syncs_of_one_run(self):
+        client = self.client_class(self.url)
+        client.sync()
+        self.fake.restart_transmission()
+        self.fake.tr_recently_active = set()
+        self.fake.pop_requests()
+
+        self.assertEqual(client.sync(), {make_hash(n).upper() for n in range(1, 4)})
+        self.assertEqual(client.torrent_ids, {n + 100: make_hash(n).upper() for n in range(1, 4)})
+        self.assertEqual(self.fake.pop_requests(), [
+            ('409', None),
+            ('session-stats', None),
+            ('torrent-get', None),
+            ('torrent-get', [101, 102, 103])
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()